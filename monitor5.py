@@ -8,15 +8,15 @@ Estratégia Híbrida: Usa a busca por links (limpeza) e o RegEx agressivo (confi
 para garantir que a NT de 29/09 e os Informes Técnicos sejam capturados e ordenados corretamente.
 """
 
-import requests
+import aiohttp
+import asyncio
+import functools
 import hashlib
 import json
 import os
-import smtplib
+import sqlite3
 import re
-from bs4 import BeautifulSoup
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from selectolax.lexbor import LexborHTMLParser
 from datetime import datetime
 from urllib.parse import urljoin
 
@@ -42,87 +42,272 @@ URLS_PORTAIS = {
 }
 
 # ---------- Arquivos locais ----------
-SEEN_HASHES_FILE = "seen_hashes.json"
+SEEN_HASHES_FILE = "seen_hashes.json"  # legado; migrado para o SQLite na 1ª execução
+SEEN_DB_FILE = "seen.db"
 USER_AGENT = "monitor-nt-sefaz/1.0 (+https://albatrosserp.com.br/)"
 
 # ---------- Regex ----------
+# Alternâncias de palavras-chave compartilhadas entre os dois passes do extrator,
+# para que novos termos sejam adicionados num lugar só.
+_KEYWORDS_LINK = r"nota técnica|nota_tecnica|informe técnico|informe tecnico"
+_KEYWORDS_AGRESSIVO = r"Nota Técnica|Informe Técnico|Informe_tecnico|Nota_tecnica|MDFE_Nota_Tecnica"
+
 # Padrão geral para detectar NT/IT no texto do link
-PATTERN = re.compile(r"(nota técnica|nota_tecnica|informe técnico|informe tecnico)", re.IGNORECASE)
+PATTERN = re.compile(r"(%s)" % _KEYWORDS_LINK, re.IGNORECASE)
+
+# Varredura barata usada como guarda: se nenhuma palavra-chave aparece no texto
+# da página, o finditer agressivo nem é executado.
+KEYWORD_SCAN = re.compile(r"(%s|%s)" % (_KEYWORDS_LINK, _KEYWORDS_AGRESSIVO), re.IGNORECASE)
 
 # Padrão para extrair data do texto (usado para ordenação)
 DATE_PATTERN = re.compile(r"(\d{2}/\d{2}/\d{4})", re.IGNORECASE)
 
 # RegEx AGRESSIVO (usado como fallback para garantir dados difíceis como 29/09)
+# O intervalo entre o título e a data é limitado a 500 chars sem quebra de linha:
+# um `.*?` com DOTALL sobre a página inteira é um risco clássico de backtracking
+# catastrófico (ReDoS) em documentos longos.
 REGEX_DATA_TITULO_AGRESSIVO = re.compile(
-    r"(Nota Técnica|Informe Técnico|Informe_tecnico|Nota_tecnica|MDFE_Nota_Tecnica).*?Publicada em (\d{2}/\d{2}/\d{4}).*?",
-    re.IGNORECASE | re.DOTALL
+    r"(%s)" % _KEYWORDS_AGRESSIVO
+    + r"[^\n]{0,500}?Publicada em (\d{2}/\d{2}/\d{4})",
+    re.IGNORECASE
 )
 
-HEADERS = {"User-Agent": USER_AGENT}
+# Remove "Publicada em DD/MM/AAAA" do título para exibição mais limpa no e-mail
+CLEANUP_PATTERN = re.compile(r"Publicada em \d{2}/\d{2}/\d{4}", re.IGNORECASE)
+
+# Normalização de espaços em uma única varredura em C, sem materializar a
+# lista intermediária de tokens que o split()+join() criaria
+WS_RE = re.compile(r"\s+")
+
+# requests já negocia gzip por padrão, mas explícito é melhor que implícito
+HEADERS = {"User-Agent": USER_AGENT, "Accept-Encoding": "gzip, deflate"}
+
+# Limite de requisições simultâneas (educado com os servidores da SEFAZ)
+MAX_CONCORRENCIA = 10
+
+# URLs de portais onde o passe agressivo deve rodar SEMPRE, mesmo quando o passe
+# limpo encontrou todos os itens com data (ajuste empírico por portal)
+PASSE_AGRESSIVO_OBRIGATORIO = set()
+
+# Escape de HTML numa única passada em C (str.translate), em vez de html.escape
+_HTML_ESCAPE_TABLE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"})
+
+# Template de linha da tabela do e-mail, formatado uma vez por item
+ROW_TEMPLATE = """
+                <tr style="{row_style}">
+                  <td style="{cell_style}">{portal}</td>
+                  <td style="{cell_style}"><a href="{url}" target="_blank" style="{link_style}">{title}</a></td>
+                  <td style="{cell_style} text-align: center;"><a href="{portal_url}" target="_blank" style="{link_style}; font-size: 13px;">🔗 Portal</a></td>
+                </tr>
+"""
 
 # ---------- Helpers ----------
-def load_seen(path):
-    if not os.path.exists(path):
-        return {}
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+def open_seen_db(path=SEEN_DB_FILE):
+    """Abre (criando se preciso) o banco de hashes já vistos e migra o
+    seen_hashes.json legado na primeira execução."""
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS seen (hash TEXT PRIMARY KEY, data TEXT)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS portal_meta ("
+        "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_sha256 TEXT)"
+    )
 
-def save_seen(path, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    is_empty = conn.execute("SELECT 1 FROM seen LIMIT 1").fetchone() is None
+    if is_empty and os.path.exists(SEEN_HASHES_FILE):
+        with open(SEEN_HASHES_FILE, "r", encoding="utf-8") as f:
+            legacy = json.load(f)
+        conn.executemany(
+            "INSERT OR IGNORE INTO seen (hash, data) VALUES (?, ?)",
+            [(h, json.dumps(d, ensure_ascii=False)) for h, d in legacy.items()]
+        )
+        conn.commit()
+        print(f"[INFO] {len(legacy)} hashes migrados de {SEEN_HASHES_FILE} para {path}")
+
+    return conn
+
+def load_seen(conn):
+    return {row[0] for row in conn.execute("SELECT hash FROM seen")}
+
+def save_seen(conn, new_entries):
+    """Insere apenas os itens novos (O(1) por item), sem reescrever o arquivo."""
+    conn.executemany(
+        "INSERT OR IGNORE INTO seen (hash, data) VALUES (?, ?)",
+        [(h, json.dumps(d, ensure_ascii=False)) for h, d in new_entries.items()]
+    )
+    conn.commit()
+
+def load_portal_meta(conn):
+    return {
+        url: {"etag": etag, "last_modified": lm, "content_sha256": body_hash}
+        for url, etag, lm, body_hash in conn.execute(
+            "SELECT url, etag, last_modified, content_sha256 FROM portal_meta"
+        )
+    }
+
+def save_portal_meta(conn, meta_by_url):
+    conn.executemany(
+        "INSERT OR REPLACE INTO portal_meta (url, etag, last_modified, content_sha256)"
+        " VALUES (?, ?, ?, ?)",
+        [(url, m.get("etag"), m.get("last_modified"), m.get("content_sha256"))
+         for url, m in meta_by_url.items()]
+    )
+    conn.commit()
 
 def sha256_text(s: str) -> str:
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
-def fetch_url(url):
+def hash_note_key(title: str, url: str) -> str:
+    """Hash do par título+URL alimentando o hasher por partes, sem montar a
+    string intermediária f\"{title}||{url}\". SHA-256 é mantido (em vez de
+    blake2b) por compatibilidade com as chaves persistidas em seen.db."""
+    h = hashlib.sha256()
+    h.update(title.encode("utf-8"))
+    h.update(b"||")
+    h.update(url.encode("utf-8"))
+    return h.hexdigest()
+
+async def fetch_url(session, url, meta=None):
+    """Busca a URL com requisição condicional (If-None-Match/If-Modified-Since)
+    quando há metadados do run anterior. Retorna (html, novo_meta); html é None
+    em caso de 304 ou erro."""
+    headers = {}
+    if meta:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
     try:
-        resp = requests.get(url, headers=HEADERS, timeout=20)
-        resp.raise_for_status()
-        return resp.text
+        async with session.get(url, headers=headers,
+                               timeout=aiohttp.ClientTimeout(total=20)) as resp:
+            if resp.status == 304:
+                print(f"[INFO] Sem mudanças (304): {url}")
+                return None, None
+            resp.raise_for_status()
+            text = await resp.text()
+            return text, {
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+            }
     except Exception as e:
         print(f"[WARN] Erro ao buscar {url}: {e}")
+        return None, None
+
+async def fetch_and_parse_all(portal_meta):
+    """Baixa todos os portais com aiohttp (uma única thread de SO) e despacha o
+    parse de cada página para o executor, para não bloquear o event loop.
+    Retorna (notes_by_portal, meta_atualizado_por_url)."""
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(MAX_CONCORRENCIA)
+    connector = aiohttp.TCPConnector(limit=20, limit_per_host=4)
+
+    async def process(portal, url):
+        meta = portal_meta.get(url)
+        async with sem:
+            print(f"[INFO] Verificando {portal}: {url}")
+            html, new_meta = await fetch_url(session, url, meta)
+        if html is None:
+            # 304 ou erro: nada a parsear, mantém o meta antigo
+            return portal, None, None
+        # Alguns servidores da SEFAZ não enviam ETag; o hash do corpo cobre
+        # esse caso e evita o parse quando o conteúdo não mudou.
+        new_meta["content_sha256"] = sha256_text(html)
+        if meta and meta.get("content_sha256") == new_meta["content_sha256"]:
+            print(f"[INFO] Conteúdo inalterado (hash): {portal}")
+            return portal, None, new_meta
+        # Estratégia Híbrida para extrair todos os itens e garantir a data mais recente
+        notes = await loop.run_in_executor(None, find_notes, html, url)
+        return portal, notes, new_meta
+
+    async with aiohttp.ClientSession(headers=HEADERS, connector=connector) as session:
+        results = await asyncio.gather(
+            *(process(portal, url) for portal, url in URLS_PORTAIS.items())
+        )
+
+    notes_by_portal = {portal: notes for portal, notes, _ in results}
+    updated_meta = {
+        URLS_PORTAIS[portal]: new_meta
+        for portal, _, new_meta in results if new_meta is not None
+    }
+    return notes_by_portal, updated_meta
+
+@functools.lru_cache(maxsize=1024)
+def _parse_ddmmyyyy(date_str):
+    """Converte 'DD/MM/AAAA' em datetime (ou None). Memoizado: as mesmas
+    datas se repetem entre portais e entre os dois passes do extrator híbrido."""
+    try:
+        return datetime.strptime(date_str, "%d/%m/%Y")
+    except ValueError:
         return None
 
 def extract_date_from_text(text):
+    # Atalho: o passe agressivo já passa a captura "DD/MM/AAAA" pronta,
+    # então não há o que varrer com regex.
+    if len(text) == 10:
+        return _parse_ddmmyyyy(text)
     match = DATE_PATTERN.search(text)
     if match:
-        date_str = match.group(1)
-        try:
-            return datetime.strptime(date_str, "%d/%m/%Y")
-        except ValueError:
-            pass
+        return _parse_ddmmyyyy(match.group(1))
     return None
 
+def _find_container(a):
+    """Sobe a árvore a partir da âncora: prefere o <tr> (normalmente carrega a
+    data), senão o <li>/<div>/<p> mais próximo — mesma semântica do antigo
+    find_parent('tr') or find_parent(['li', 'div', 'p']). O container mais
+    próximo importa: um wrapper externo traria a primeira data de outra linha."""
+    container = None
+    node = a.parent
+    while node is not None and node.tag not in ("body", "html"):
+        if node.tag == "tr":
+            return node
+        if container is None and node.tag in ("li", "div", "p"):
+            container = node
+        node = node.parent
+    return container
+
 def find_notes(html, base_url):
-    soup = BeautifulSoup(html, "html.parser")
+    tree = LexborHTMLParser(html)
     dated_notes = {} # Usamos dict para garantir unicidade pelo hash
 
     # 1. Método Robust/Limpo (Busca por Links) - Prioriza URLs e Títulos corretos
-    for a in soup.find_all("a", string=True):
-        text = a.get_text(strip=True)
-        
-        if PATTERN.search(text):
-            href = a.get("href") or ""
+    for a in tree.css("a"):
+        text = a.text(strip=True)
+
+        if text and PATTERN.search(text):
+            href = a.attributes.get("href") or ""
             full_url = urljoin(base_url, href)
-            
-            # Tenta encontrar a data para ordenação
-            item_container = a.find_parent('tr') or a.find_parent(['li', 'div', 'p'])
-            item_text = item_container.get_text(" ", strip=True) if item_container else text
+
+            # Tenta encontrar a data para ordenação (container mais próximo)
+            item_container = _find_container(a)
+            item_text = WS_RE.sub(" ", item_container.text(separator=" ")).strip() if item_container is not None else text
             date_obj = extract_date_from_text(item_text)
 
             # A chave de hash aqui é TÍTULO + URL (o mais limpo possível)
-            hash_key = sha256_text(f"{text}||{full_url}")
+            hash_key = hash_note_key(text, full_url)
 
-            if hash_key not in dated_notes:
-                dated_notes[hash_key] = {
-                    "title": text, 
-                    "url": full_url,
-                    "date": date_obj 
-                }
+            # setdefault faz lookup + inserção numa única operação de hash
+            dated_notes.setdefault(hash_key, {
+                "title": text,
+                "url": full_url,
+                "date": date_obj,
+                "hash": hash_key
+            })
 
     # 2. Método Agressivo (RegEx em texto simples) - Garante a detecção de datas difíceis (como 29/09)
-    texto_simples = ' '.join(soup.get_text(" ", strip=True).split()) 
-    ocorrencias = REGEX_DATA_TITULO_AGRESSIVO.finditer(texto_simples)
+    # Se o passe limpo já encontrou itens e todos têm data, o passe agressivo só
+    # re-varreria a página inteira para achar o que já temos — pula, a menos que
+    # o portal esteja marcado em PASSE_AGRESSIVO_OBRIGATORIO.
+    precisa_agressivo = (
+        base_url in PASSE_AGRESSIVO_OBRIGATORIO
+        or not dated_notes
+        or any(n["date"] is None for n in dated_notes.values())
+    )
+
+    ocorrencias = ()
+    if precisa_agressivo:
+        body = tree.body
+        texto_simples = WS_RE.sub(" ", body.text(separator=" ")).strip() if body is not None else ""
+        if KEYWORD_SCAN.search(texto_simples):
+            ocorrencias = REGEX_DATA_TITULO_AGRESSIVO.finditer(texto_simples)
 
     for match in ocorrencias:
         titulo_completo = match.group(0).strip()
@@ -132,16 +317,16 @@ def find_notes(html, base_url):
             date_obj = extract_date_from_text(data_publicacao_str)
             
             # A URL é o base_url, e o título é o bloco RegEx
-            hash_key = sha256_text(f"{titulo_completo[:150]}||{base_url}")
-
-            # Se esta nota já foi encontrada pelo método limpo, ignora a versão RegEx.
-            # Se não foi encontrada, adiciona ou atualiza a entrada com a data.
-            if hash_key not in dated_notes:
-                 dated_notes[hash_key] = {
-                    "title": titulo_completo,
-                    "url": base_url,
-                    "date": date_obj 
-                }
+            hash_key = hash_note_key(titulo_completo[:150], base_url)
+
+            # Se esta nota já foi encontrada pelo método limpo, setdefault mantém
+            # a versão limpa; se não, adiciona a entrada RegEx com a data.
+            dated_notes.setdefault(hash_key, {
+                "title": titulo_completo,
+                "url": base_url,
+                "date": date_obj,
+                "hash": hash_key
+            })
 
     # 3. Ordenação: Data mais recente primeiro.
     # Converte o dicionário de volta para lista para ordenação
@@ -152,10 +337,16 @@ def find_notes(html, base_url):
         reverse=True
     )
     
-    # 4. Retorna a lista final de dicionários (title, url)
-    return [{"title": n["title"], "url": n["url"]} for n in final_list]
+    # 4. Retorna a lista final de dicionários (title, url, hash)
+    return [{"title": n["title"], "url": n["url"], "hash": n["hash"]} for n in final_list]
 
 def send_email(new_items_by_portal):
+    # Imports adiados: só pagam o custo (smtplib puxa ssl/hmac) nos runs que
+    # realmente enviam e-mail — a exceção num daemon de monitoramento
+    import smtplib
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
     msg = MIMEMultipart("alternative")
     now = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
     
@@ -209,23 +400,23 @@ def send_email(new_items_by_portal):
     link_style = f"color: {PRIMARY_COLOR}; text-decoration: none; font-weight: 500;"
     
     i = 0
-    # RegEx para limpar a data do título, se presente, para uma exibição mais limpa
-    CLEANUP_PATTERN = re.compile(r"Publicada em \d{2}/\d{2}/\d{4}", re.IGNORECASE)
-
+    rows = []
     for portal, items in new_items_by_portal.items():
+        portal_prefix_len = len(portal)
         # Limite de 3 itens por portal
-        for it in items[:3]: 
+        for it in items[:3]:
             raw_title = it["title"]
-            title_clean = raw_title
-            
+
             # 1. Tenta limpar qualquer "Publicada em DD/MM/AAAA" que possa ter sido capturado (útil para o RegEx agressivo)
-            title_clean = CLEANUP_PATTERN.sub('', raw_title).strip()
-            
+            # subn evita alocar uma cópia do título quando não há nada a limpar
+            title_clean, n_subs = CLEANUP_PATTERN.subn('', raw_title)
+            title_clean = title_clean.strip() if n_subs else raw_title
+
             # 2. Se o título for muito longo (veio do RegEx agressivo), tenta remover o nome do portal e truncar.
             if len(title_clean) > 80:
                 # Remove o nome completo do portal, que é o que está aparecendo repetidamente
                 if title_clean.startswith(portal):
-                    title_clean = title_clean[len(portal):].strip(' -:')
+                    title_clean = title_clean[portal_prefix_len:].strip(' -:')
                 if len(title_clean) > 80:
                    title_clean = title_clean[:77] + '...'
             
@@ -235,15 +426,18 @@ def send_email(new_items_by_portal):
 
             row_style = row_style_light if i % 2 == 0 else row_style_white
             i += 1
-            
-            html_parts.append(f"""
-                <tr style="{row_style}">
-                  <td style="{cell_style}">{portal}</td>
-                  <td style="{cell_style}"><a href="{it['url']}" target="_blank" style="{link_style}">{title_clean}</a></td>
-                  <td style="{cell_style} text-align: center;"><a href="{URLS_PORTAIS[portal]}" target="_blank" style="{link_style}; font-size: 13px;">🔗 Portal</a></td>
-                </tr>
-            """)
-    
+
+            rows.append(ROW_TEMPLATE.format(
+                row_style=row_style,
+                cell_style=cell_style,
+                link_style=link_style,
+                portal=portal.translate(_HTML_ESCAPE_TABLE),
+                url=it['url'],
+                title=title_clean.translate(_HTML_ESCAPE_TABLE),
+                portal_url=URLS_PORTAIS[portal],
+            ))
+
+    html_parts.append("".join(rows))
     html_parts.append(f"""
                   </tbody>
                 </table>
@@ -290,28 +484,32 @@ def main():
     if not SENHA_EMAIL:
         print("[ERRO] Variável de ambiente SENHA_APP não configurada. Configure a senha de aplicativo do Gmail para enviar e-mails.")
 
-    seen = load_seen(SEEN_HASHES_FILE)
-    new_found_by_portal = {} 
-    updated_seen = seen.copy() 
+    conn = open_seen_db()
+    seen = load_seen(conn)
+    new_found_by_portal = {}
+    new_entries = {}
+
+    # Busca e parse de todos os portais em paralelo (asyncio + aiohttp).
+    # As mutações de seen/new_entries ficam aqui na thread principal, sem lock.
+    portal_meta = load_portal_meta(conn)
+    notes_by_portal, updated_meta = asyncio.run(fetch_and_parse_all(portal_meta))
+    if updated_meta:
+        save_portal_meta(conn, updated_meta)
 
+    # Mantém a ordem original dos portais no e-mail consolidado
     for portal, url in URLS_PORTAIS.items():
-        print(f"[INFO] Verificando {portal}: {url}")
-        html = fetch_url(url)
-        if not html:
+        notes = notes_by_portal[portal]
+        if notes is None:
             continue
-        
-        # Estratégia Híbrida para extrair todos os itens e garantir a data mais recente
-        notes = find_notes(html, url)
-        
+
         portal_new_items = []
         
         for n in notes:
-            # O hash usa o TÍTULO e a URL para unicidade.
-            key_text = f"{n['title']}||{n['url']}"
-            h = sha256_text(key_text)
-            
+            # O hash (título + URL) já foi calculado em find_notes; reutiliza.
+            h = n["hash"]
+
             if h not in seen:
-                updated_seen[h] = {
+                new_entries[h] = {
                     "title": n["title"],
                     "url": n["url"],
                     "portal": portal,
@@ -323,7 +521,8 @@ def main():
             print(f"[INFO] {len(portal_new_items)} novos itens detectados em {portal}.")
             new_found_by_portal[portal] = portal_new_items
 
-    save_seen(SEEN_HASHES_FILE, updated_seen)
+    save_seen(conn, new_entries)
+    conn.close()
 
     total_new_items = sum(len(items) for items in new_found_by_portal.values())
 